@@ -1,61 +1,164 @@
+import base64
+import binascii
+import hashlib
+import hmac
 import logging
-from datetime import datetime, timedelta, UTC
-from typing import Dict, Any, Optional
+import time
+from typing import Dict, Any, Optional, Tuple
 
 import jwt
+import orjson
+from cachetools import TTLCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 
 LOGGER = logging.getLogger("xiaomi_api.auth")
 
+# 全局共享的 Bearer 提取器，供 JWTAuth 实例与依赖注入复用
+_bearer = HTTPBearer()
+
+
+# 认证失败时每次构造新的异常实例：共享实例会通过 __traceback__/__context__
+# 持有上一次失败请求的栈帧（含 token、payload），且会被并发请求同时改写
+def _unauthorized(detail: str) -> HTTPException:
+    return HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=detail)
+
+
+def _wrong_type_error(token_type: str) -> HTTPException:
+    return _unauthorized(f"Token 类型错误，期望 {token_type}")
+
+
+# {"alg":"HS256","typ":"JWT"} 的 base64url 编码，与 PyJWT 生成的头部一致
+_HS256_HEADER = b"eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9"
+
+
+def _b64url_encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def _b64url_decode(data: bytes) -> bytes:
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+
+def _hs256_encode(payload: Dict[str, Any], key: bytes) -> str:
+    """直接用 hmac 签发 HS256 JWT，绕开 PyJWT 的通用算法分发。"""
+    body = _b64url_encode(orjson.dumps(payload))
+    signing_input = _HS256_HEADER + b"." + body
+    signature = _b64url_encode(hmac.new(key, signing_input, hashlib.sha256).digest())
+    return (signing_input + b"." + signature).decode("ascii")
+
+
+def _hs256_split(token: str) -> Tuple[bytes, bytes, Dict[str, Any]]:
+    """拆分 HS256 JWT，返回 (签名输入, 签名, 未校验的 payload)；异常类型与 PyJWT 一致。"""
+    try:
+        raw = token.encode("ascii")
+        header, body, signature = raw.split(b".")
+        if header != _HS256_HEADER and orjson.loads(_b64url_decode(header)).get("alg") != "HS256":
+            raise jwt.DecodeError("The specified alg value is not allowed")
+        payload = orjson.loads(_b64url_decode(body))
+        signature = _b64url_decode(signature)
+    except (ValueError, binascii.Error, AttributeError) as exc:
+        raise jwt.DecodeError("Invalid token") from exc
+    if not isinstance(payload, dict):
+        raise jwt.DecodeError("Invalid payload string: must be a json object")
+    return raw[:len(header) + len(body) + 1], signature, payload
+
+
+def _hs256_verify(signing_input: bytes, signature: bytes, payload: Dict[str, Any], key: bytes) -> None:
+    """校验 HS256 签名与 exp。"""
+    expected = hmac.new(key, signing_input, hashlib.sha256).digest()
+    if not hmac.compare_digest(expected, signature):
+        raise jwt.InvalidSignatureError("Signature verification failed")
+    exp = payload.get("exp")
+    if exp is not None:
+        if isinstance(exp, bool) or not isinstance(exp, (int, float)):
+            raise jwt.DecodeError("Expiration Time claim (exp) must be an integer.")
+        if exp <= time.time():
+            raise jwt.ExpiredSignatureError("Signature has expired")
+
 
 class JWTAuth:
     def __init__(self, secret_key: str, algorithm: str = "HS256", access_minutes: int = 60, refresh_days: int = 7, auto_refresh_threshold_minutes: int = 10):
         self.secret_key = secret_key
+        # 预先编码签名密钥，避免每次签发/校验时重复 str -> bytes
+        self._key_bytes = secret_key.encode("utf-8")
         self.algorithm = algorithm
+        # HS256 走内置 hmac 实现，其余算法仍交给 PyJWT
+        self._use_hs256 = algorithm == "HS256"
         self.access_minutes = access_minutes
         self.refresh_days = refresh_days
         self.auto_refresh_threshold_minutes = auto_refresh_threshold_minutes
-        self.security = HTTPBearer()
+        self.access_seconds = access_minutes * 60
+        self.refresh_seconds = refresh_days * 86400
+        self.auto_refresh_threshold_seconds = auto_refresh_threshold_minutes * 60
+        self.security = _bearer
+        # 已验证 token 的 payload 缓存：最大 4096 条，TTL 60 秒
+        self._payload_cache = TTLCache(maxsize=4096, ttl=60)
+
+    def _encode(self, payload: Dict[str, Any]) -> str:
+        if self._use_hs256:
+            return _hs256_encode(payload, self._key_bytes)
+        return jwt.encode(payload, self._key_bytes, algorithm=self.algorithm)
+
+    def _decode(self, token: str, token_type: str) -> Dict[str, Any]:
+        # 先用未校验的 payload 比对类型（JWT 的 payload 本就是明文），类型不符时省去签名计算
+        if self._use_hs256:
+            signing_input, signature, payload = _hs256_split(token)
+            if payload.get("type") != token_type:
+                raise _wrong_type_error(token_type)
+            _hs256_verify(signing_input, signature, payload, self._key_bytes)
+            return payload
+        try:
+            unverified = jwt.decode(token, options={"verify_signature": False})
+            if unverified.get("type") != token_type:
+                raise _wrong_type_error(token_type)
+            return jwt.decode(token, self._key_bytes, algorithms=[self.algorithm])
+        except (jwt.ExpiredSignatureError, jwt.DecodeError):
+            raise
+        except jwt.PyJWTError as exc:
+            # 其余 PyJWT 异常（如算法不匹配）归为解析失败，verify_token 只需处理三类异常
+            raise jwt.DecodeError(str(exc)) from exc
 
     def create_access_token(self, data: Dict[str, Any]) -> str:
         to_encode = data.copy()
-        expire = datetime.now(UTC) + timedelta(minutes=self.access_minutes)
-        to_encode.update({"exp": expire, "type": "access"})
-        return jwt.encode(to_encode, self.secret_key, algorithm=self.algorithm)
+        to_encode["exp"] = int(time.time()) + self.access_seconds
+        to_encode["type"] = "access"
+        return self._encode(to_encode)
 
     def create_refresh_token(self, data: Dict[str, Any]) -> str:
         to_encode = data.copy()
-        expire = datetime.now(UTC) + timedelta(days=self.refresh_days)
-        to_encode.update({"exp": expire, "type": "refresh"})
-        return jwt.encode(to_encode, self.secret_key, algorithm=self.algorithm)
+        to_encode["exp"] = int(time.time()) + self.refresh_seconds
+        to_encode["type"] = "refresh"
+        return self._encode(to_encode)
 
     def verify_token(self, token: str, token_type: str = "access") -> Dict[str, Any]:
+        # 命中缓存且未过期时跳过签名校验与解码；过期的交给 _decode 给出准确错误
+        cached = self._payload_cache.get(token)
+        if cached is not None and cached.get("exp", 0) > time.time() + 1:
+            if cached.get("type") != token_type:
+                raise _wrong_type_error(token_type)
+            return dict(cached)
         try:
-            payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
-            if payload.get("type") != token_type:
-                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"Token 类型错误，期望 {token_type}")
-            return payload
+            payload = self._decode(token, token_type)
+            self._payload_cache[token] = payload
+            # 返回副本，调用方（如 get_current_user）会写入 _should_refresh
+            return dict(payload)
         except jwt.ExpiredSignatureError:
             # 区分过期
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token 已过期，请使用刷新令牌重新获取访问令牌")
+            raise _unauthorized("Token 已过期，请使用刷新令牌重新获取访问令牌") from None
         except jwt.InvalidSignatureError:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token 签名无效")
+            raise _unauthorized("Token 签名无效") from None
         except jwt.DecodeError:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token 解析失败")
-        except jwt.PyJWTError:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token 无效")
+            raise _unauthorized("Token 解析失败") from None
 
     def check_token_should_refresh(self, payload: Dict[str, Any]) -> bool:
         exp = payload.get("exp")
         if not exp:
             return True
-        exp_time = datetime.fromtimestamp(exp, tz=UTC)
-        time_left = exp_time - datetime.now(UTC)
-        return time_left.total_seconds() < (self.auto_refresh_threshold_minutes * 60)
+        return exp - time.time() < self.auto_refresh_threshold_seconds
 
-    async def get_current_user(self, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())) -> Dict[str, Any]:
+    async def get_current_user(self, credentials: HTTPAuthorizationCredentials = Depends(_bearer)) -> Dict[str, Any]:
         token = credentials.credentials
         payload = self.verify_token(token, "access")
         if self.check_token_should_refresh(payload):
@@ -63,8 +166,10 @@ class JWTAuth:
         return payload
 
 
-def authenticate_system_user(username: str, password: str, users: Dict[str, str]) -> bool:
+def authenticate_system_user(username: str, password: str, users: Dict[str, bytes]) -> bool:
+    # users 中的密码需预先编码为 bytes，使用常量时间比较避免时序侧信道
     expected_password = users.get(username)
-    return expected_password is not None and expected_password == password
+    # surrogatepass：请求中的孤立代理字符（合法 JSON）不应导致编码异常
+    return expected_password is not None and hmac.compare_digest(expected_password, password.encode("utf-8", "surrogatepass"))
 
 
@@ -1,3 +1,5 @@
+from types import MappingProxyType
+
 SUPPORT_MUSIC_TYPE = [
     ".mp3",
     ".flac",
@@ -11,6 +13,12 @@ SUPPORT_MUSIC_TYPE = [
 LATEST_ASK_API = "https://userprofile.mina.mi.com/device_profile/v2/conversation?source=dialogu&hardware={hardware}&timestamp={timestamp}&limit=2"
 COOKIE_TEMPLATE = "deviceId={device_id}; serviceToken={service_token}; userId={user_id}"
 
+# 校验会话 token 时请求设备列表所用的接口与请求头（只读映射，所有请求共用同一对象）
+DEVICE_LIST_URL = "https://api2.mina.mi.com/admin/v2/device_list?master=0"
+MIHOME_HEADERS = MappingProxyType({
+    "User-Agent": "MiHome/6.0.103 (com.xiaomi.mihome; build:6.0.103.1; iOS 14.4.0) Alamofire/6.0.103 MICO/iOSApp/appStore/6.0.103",
+})
+
 PLAY_TYPE_ONE = 0  # 单曲循环
 PLAY_TYPE_ALL = 1  # 全部循环
 PLAY_TYPE_RND = 2  # 随机播放
@@ -1,27 +1,28 @@
 import asyncio
 import os
 import logging
-from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
 from contextlib import asynccontextmanager
 from pathlib import Path
 import json
 
-import jwt
 import yaml
-from fastapi import FastAPI, HTTPException, Depends, status, Request
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
-from aiohttp import ClientSession
-from cachetools import TTLCache
-from auth import JWTAuth
-from mi_session import MinaProvider
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from auth import JWTAuth, authenticate_system_user as _authenticate_system_user
+from mi_session import MinaProvider, get_miio_service
 from routes import get_router
 
-from miservice import MiAccount, MiNAService, MiIOService, miio_command, miio_command_help
+from miservice import MiAccount, MiNAService, miio_command, miio_command_help
 
-from const import TTS_COMMAND
+from const import DEVICE_LIST_URL, MIHOME_HEADERS, TTS_COMMAND
+from utils import parse_tts_cmd
+
+
+# 优先使用 libyaml 的 C 实现，未编译 libyaml 时回退纯 Python 的 SafeLoader
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 
 # 配置加载函数
@@ -32,7 +33,7 @@ def load_config(config_path: str = "conf/config.yml") -> Dict[str, Any]:
         raise FileNotFoundError(f"配置文件不存在: {config_path}")
     
     with open(config_file, 'r', encoding='utf-8') as f:
-        config = yaml.safe_load(f)
+        config = yaml.load(f, Loader=YAML_LOADER)
     
     return config
 
@@ -48,8 +49,9 @@ LOG_DATE_FORMAT = log_config.get('date_format', '%H:%M:%S')
 
 # 配置日志
 LOGGER = logging.getLogger("xiaomi_api")
+LOG_LEVEL_VALUE = getattr(logging, LOG_LEVEL.upper(), logging.INFO)
 logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL.upper(), logging.INFO),
+    level=LOG_LEVEL_VALUE,
     format=LOG_FORMAT,
     datefmt=LOG_DATE_FORMAT
 )
@@ -57,6 +59,10 @@ logging.basicConfig(
 # 小米会话文件路径（硬编码）
 MI_TOKEN_PATH = 'conf/.mi_account_session.json'
 
+# 小米会话配置
+mi_config = config.get('mi', {})
+MI_WATCH_INTERVAL = mi_config.get('watch_interval_seconds', 30)
+
 # 系统登录配置（用于我们自己的系统登录）
 system_auth_config = config.get('system_auth', {})
 SYSTEM_USERS: Dict[str, str] = {
@@ -64,6 +70,16 @@ SYSTEM_USERS: Dict[str, str] = {
     for user in system_auth_config.get('users', [])
     if isinstance(user, dict) and user.get('username') is not None
 }
+# 预先编码的密码，供常量时间比较使用；只接受字符串密码（与原先的 == 比较一致），
+# 如 YAML 中未加引号的 123456 / yes 会被解析为数字/布尔，这类用户无法登录
+SYSTEM_USERS_BYTES: Dict[str, bytes] = {
+    username: password.encode("utf-8", "surrogatepass")
+    for username, password in SYSTEM_USERS.items()
+    if isinstance(password, str)
+}
+for _username, _password in SYSTEM_USERS.items():
+    if _password is not None and not isinstance(_password, str):
+        LOGGER.warning("系统用户 %s 的密码不是字符串（YAML 中请加引号），该用户无法登录", _username)
 if not SYSTEM_USERS:
     LOGGER.warning("未在 conf/config.yml 中配置 system_auth.users，系统登录将无法通过校验")
 
@@ -79,7 +95,15 @@ JWT_EXPIRE_MINUTES = jwt_config.get('access_token_expire_minutes', 60)
 JWT_REFRESH_EXPIRE_DAYS = jwt_config.get('refresh_token_expire_days', 7)
 JWT_AUTO_REFRESH_THRESHOLD = jwt_config.get('auto_refresh_threshold_minutes', 10)
 
-LOGGER.info(f"JWT 配置已加载 | 算法: {JWT_ALGORITHM} | 访问令牌过期: {JWT_EXPIRE_MINUTES}分钟 | 刷新令牌过期: {JWT_REFRESH_EXPIRE_DAYS}天")
+LOGGER.info("JWT 配置已加载 | 算法: %s | 访问令牌过期: %s分钟 | 刷新令牌过期: %s天", JWT_ALGORITHM, JWT_EXPIRE_MINUTES, JWT_REFRESH_EXPIRE_DAYS)
+
+jwt_auth_for_routes = JWTAuth(
+    secret_key=JWT_SECRET_KEY,
+    algorithm=JWT_ALGORITHM,
+    access_minutes=JWT_EXPIRE_MINUTES,
+    refresh_days=JWT_REFRESH_EXPIRE_DAYS,
+    auto_refresh_threshold_minutes=JWT_AUTO_REFRESH_THRESHOLD,
+)
 
 # API 服务配置
 api_config = config.get('api', {})
@@ -91,8 +115,6 @@ DEBUG = api_config.get('debug', False)
 http_session: Optional[ClientSession] = None
 mi_account: Optional[MiAccount] = None
 mina_service: Optional[MiNAService] = None
-# 设备列表TTL缓存（仅用于 resolve_device_id 内部使用）
-devices_ttl_cache: TTLCache = TTLCache(maxsize=1, ttl=30)
 # Provider 实例（为路由模块提供）
 mina_provider: MinaProvider | None = None
 
@@ -200,8 +222,9 @@ async def lifespan(app: FastAPI):
     global http_session, mi_account, mina_service
     LOGGER.info("启动 FastAPI 应用...")
     
-    # 创建 HTTP 会话
-    http_session = ClientSession()
+    # 创建进程内共享的 HTTP 会话：连接池复用 TCP/TLS 连接，DNS 结果缓存 20 秒
+    connector = TCPConnector(limit_per_host=50, ttl_dns_cache=20)
+    http_session = ClientSession(connector=connector, timeout=ClientTimeout(total=10, connect=3))
     LOGGER.info("HTTP 会话已创建")
     
     # 确保配置目录存在
@@ -212,19 +235,19 @@ async def lifespan(app: FastAPI):
     try:
         global mina_provider
         from mi_session import MinaProvider
-        mina_provider = MinaProvider(MI_TOKEN_PATH, http_session)
+        mina_provider = MinaProvider(MI_TOKEN_PATH, http_session, watch_interval=MI_WATCH_INTERVAL)
         restored = await mina_provider.try_restore_from_file()
         # 启动会话文件监听
         try:
             await mina_provider.start_session_file_watcher()
         except Exception as _exc:
-            LOGGER.warning(f"会话文件监听启动失败：{_exc}")
+            LOGGER.warning("会话文件监听启动失败：%s", _exc)
         if restored:
             LOGGER.info("已基于会话文件恢复小米会话")
         else:
             LOGGER.info("未能基于会话文件恢复，需要登录后方可使用")
     except Exception as exc:
-        LOGGER.warning(f"启动时会话文件恢复失败：{exc}")
+        LOGGER.warning("启动时会话文件恢复失败：%s", exc)
     
     yield
     
@@ -240,73 +263,16 @@ async def lifespan(app: FastAPI):
         pass
 
 
-# JWT 工具函数
-def create_access_token(data: dict) -> str:
-    """创建访问令牌"""
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=JWT_EXPIRE_MINUTES)
-    to_encode.update({
-        "exp": expire,
-        "type": "access"
-    })
-    encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
-    return encoded_jwt
-
-
-def create_refresh_token(data: dict) -> str:
-    """创建刷新令牌"""
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(days=JWT_REFRESH_EXPIRE_DAYS)
-    to_encode.update({
-        "exp": expire,
-        "type": "refresh"
-    })
-    encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
-    return encoded_jwt
-
-
-def verify_token(token: str, token_type: str = "access") -> dict:
-    """验证 JWT token"""
-    try:
-        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-        
-        # 检查 token 类型
-        if payload.get("type") != token_type:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail=f"Token 类型错误，期望 {token_type}",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        
-        return payload
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token 已过期，请使用刷新令牌获取新的访问令牌")
-    except jwt.InvalidSignatureError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token 签名无效")
-    except jwt.DecodeError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token 解析失败")
-    except jwt.PyJWTError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token 无效")
-
-
-def check_token_expiry(payload: dict) -> bool:
-    """检查 Token 是否即将过期（需要刷新）"""
-    exp = payload.get("exp")
-    if not exp:
-        return True
-    
-    exp_time = datetime.fromtimestamp(exp)
-    current_time = datetime.utcnow()
-    time_left = exp_time - current_time
-    
-    # 如果剩余时间少于阈值，需要刷新
-    return time_left.total_seconds() < (JWT_AUTO_REFRESH_THRESHOLD * 60)
+# JWT 工具函数：统一委托给 JWTAuth，保留模块级入口以兼容旧调用
+create_access_token = jwt_auth_for_routes.create_access_token
+create_refresh_token = jwt_auth_for_routes.create_refresh_token
+verify_token = jwt_auth_for_routes.verify_token
+check_token_expiry = jwt_auth_for_routes.check_token_should_refresh
 
 
 def authenticate_system_user(username: str, password: str) -> bool:
     """校验系统用户名与密码是否匹配配置"""
-    expected_password = SYSTEM_USERS.get(username)
-    return expected_password is not None and expected_password == password
+    return _authenticate_system_user(username, password, SYSTEM_USERS_BYTES)
 
 
 # 应用信息配置
@@ -315,12 +281,18 @@ APP_NAME = app_config.get('name', '小米音响控制 API')
 APP_VERSION = app_config.get('version', '1.0.0')
 APP_DESCRIPTION = app_config.get('description', '基于 FastAPI 和 MiService 的小米音响控制接口')
 
-# 创建 FastAPI 应用
-app = FastAPI(title=APP_NAME, description=APP_DESCRIPTION, version=APP_VERSION, lifespan=lifespan)
+# 创建 FastAPI 应用（响应统一用 orjson 序列化）
+app = FastAPI(title=APP_NAME, description=APP_DESCRIPTION, version=APP_VERSION, lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# 不含敏感数据的探活路由，无需缓存控制头
+NO_CACHE_EXEMPT_PATHS = frozenset({"/", "/health"})
 
 """全局缓存控制中间件，防止敏感 JSON 被缓存"""
 @app.middleware("http")
 async def add_no_cache_headers(request: Request, call_next):
+    # 直接读 scope 中的 path，避免为探活请求构造 URL 对象
+    if request.scope["path"] in NO_CACHE_EXEMPT_PATHS:
+        return await call_next(request)
     response = await call_next(request)
     response.headers["Cache-Control"] = "no-store"
     response.headers["Pragma"] = "no-cache"
@@ -329,14 +301,12 @@ async def add_no_cache_headers(request: Request, call_next):
 # 统一异常处理：返回 {"detail": "..."}，并保持 4xx/5xx 状态码
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
-    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+    return ORJSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
 
 @app.exception_handler(Exception)
 async def unhandled_exception_handler(request: Request, exc: Exception):
-    LOGGER.exception(f"Unhandled exception: {exc}")
-    return JSONResponse(status_code=500, content={"detail": "服务器内部错误"})
-
-security = HTTPBearer()
+    LOGGER.exception("Unhandled exception: %s", exc)
+    return ORJSONResponse(status_code=500, content={"detail": "服务器内部错误"})
 
 
 # 依赖注入
@@ -346,18 +316,7 @@ async def get_http_session() -> ClientSession:
     return http_session
 
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    """获取当前用户（验证 JWT token，支持自动刷新提醒）"""
-    token = credentials.credentials
-    payload = verify_token(token, "access")
-    
-    # 检查是否需要刷新
-    if check_token_expiry(payload):
-        LOGGER.info(f"Token 即将过期，建议刷新 | user={payload.get('sub')}")
-        # 在响应头中添加刷新提醒（可选）
-        payload["_should_refresh"] = True
-    
-    return payload
+get_current_user = jwt_auth_for_routes.get_current_user
 
 
 async def get_mina_service(current_user: dict = Depends(get_current_user)) -> MiNAService:
@@ -367,7 +326,7 @@ async def get_mina_service(current_user: dict = Depends(get_current_user)) -> Mi
         try:
             restored = await try_restore_session_from_file_only()
         except Exception as exc:
-            LOGGER.warning(f"懒加载恢复失败：{exc}")
+            LOGGER.warning("懒加载恢复失败：%s", exc)
             restored = False
         if not restored:
             raise HTTPException(status_code=401, detail="请先登录小米账号")
@@ -382,7 +341,9 @@ async def login_with_session_check(session: ClientSession, username: str, passwo
     LOGGER.info("准备登录：检查会话目录与文件")
     token_dir = os.path.dirname(MI_TOKEN_PATH) or "."
     os.makedirs(token_dir, exist_ok=True)
-    LOGGER.debug(f"会话文件路径: {MI_TOKEN_PATH} | 存在: {os.path.exists(MI_TOKEN_PATH)}")
+    # os.path.exists 会触发一次 stat，仅在 DEBUG 级别开启时执行
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug("会话文件路径: %s | 存在: %s", MI_TOKEN_PATH, os.path.exists(MI_TOKEN_PATH))
 
     async def do_login() -> tuple[MiAccount, MiNAService, List[Dict[str, Any]]]:
         LOGGER.info("执行登录流程（可能复用会话）")
@@ -392,7 +353,7 @@ async def login_with_session_check(session: ClientSession, username: str, passwo
         mina = MiNAService(account)
         LOGGER.debug("拉取设备列表进行校验")
         devices = await mina.device_list()
-        LOGGER.info(f"设备数量: {len(devices) if devices is not None else 0}")
+        LOGGER.info("设备数量: %d", len(devices) if devices is not None else 0)
         return account, mina, devices or []
 
     # 情况一：已有 session，则先用其校验设备列表
@@ -403,7 +364,7 @@ async def login_with_session_check(session: ClientSession, username: str, passwo
             LOGGER.info("会话有效，继续使用现有会话")
             return account, mina, devices
         except Exception as exc:
-            LOGGER.warning(f"会话验证失败，将清空并重登。原因: {exc}")
+            LOGGER.warning("会话验证失败，将清空并重登。原因: %s", exc)
             try:
                 os.remove(MI_TOKEN_PATH)
                 LOGGER.debug("已删除无效会话文件")
@@ -446,11 +407,7 @@ async def try_restore_session_from_file_only() -> bool:
         account.token = token
 
         # 直接请求设备列表，rel==False 防止 Auth 失败时自动重登
-        headers = {
-            'User-Agent': 'MiHome/6.0.103 (com.xiaomi.mihome; build:6.0.103.1; iOS 14.4.0) Alamofire/6.0.103 MICO/iOSApp/appStore/6.0.103'
-        }
-        url = 'https://api2.mina.mi.com/admin/v2/device_list?master=0'
-        resp = await account.mi_request('micoapi', url, None, headers, relogin=False)
+        resp = await account.mi_request('micoapi', DEVICE_LIST_URL, None, MIHOME_HEADERS, relogin=False)
 
         if resp and resp.get('code') == 0:
             devices = resp.get('data') or []
@@ -463,53 +420,13 @@ async def try_restore_session_from_file_only() -> bool:
         return False
 
     except Exception as exc:
-        LOGGER.warning(f"会话文件恢复失败，需重新登录：{exc}")
+        LOGGER.warning("会话文件恢复失败，需重新登录：%s", exc)
         mi_account = None
         mina_service = None
         # 不缓存设备列表
         return False
 
 
-def find_device_by_selector(devices: List[Dict[str, Any]], selector: str) -> Optional[str]:
-    """根据选择器查找设备ID"""
-    if not selector:
-        return devices[0].get("deviceID") if devices else None
-    
-    # 1) 已是 deviceID（形如 UUID，有横杠）
-    if "-" in selector and any(d.get("deviceID") == selector for d in devices):
-        return selector
-    
-    # 2) 是 miotDID（纯数字）
-    if selector.isdigit():
-        for d in devices:
-            if str(d.get("miotDID")) == selector:
-                return d.get("deviceID")
-    
-    # 3) 按别名/名称匹配
-    for d in devices:
-        if d.get("alias") == selector or d.get("name") == selector:
-            return d.get("deviceID")
-    
-    # 兜底：第一台
-    return devices[0].get("deviceID") if devices else None
-
-
-async def resolve_device_id(selector: str, mina: MiNAService) -> str:
-    """解析设备选择器为设备ID，如果失败则抛出异常"""
-    devices = devices_ttl_cache.get("devices")
-    if devices is None:
-        devices = await mina.device_list() or []
-        devices_ttl_cache["devices"] = devices
-    device_id = find_device_by_selector(devices, selector)
-    if not device_id:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"未找到匹配的设备: {selector}。请先调用 /devices 查看可用设备"
-        )
-    
-    return device_id
-
-
 @app.get("/")
 async def root():
     return {"detail": "小米音响控制 API 服务正在运行", "version": APP_VERSION}
@@ -520,17 +437,6 @@ async def health_check():
     return {"detail": "服务健康"}
 
 
-from routes import get_router
-from auth import JWTAuth
-
-system_users = {u.get('username'): u.get('password') for u in config.get('system_auth', {}).get('users', []) if isinstance(u, dict)}
-jwt_auth_for_routes = JWTAuth(
-    secret_key=JWT_SECRET_KEY,
-    algorithm=JWT_ALGORITHM,
-    access_minutes=JWT_EXPIRE_MINUTES,
-    refresh_days=JWT_REFRESH_EXPIRE_DAYS,
-    auto_refresh_threshold_minutes=JWT_AUTO_REFRESH_THRESHOLD,
-)
 # 合并后的路由由 get_router 提供，无需单独注册 auth 路由
 
 
@@ -543,7 +449,7 @@ def _get_provider():
         raise HTTPException(status_code=500, detail="小米 Provider 未初始化")
     return mina_provider
 
-app.include_router(get_router(jwt_auth_for_routes, system_users, _get_provider))
+app.include_router(get_router(jwt_auth_for_routes, SYSTEM_USERS_BYTES, _get_provider))
 
 
 """/mi/* 路由已移至 routes_mi.py"""
@@ -605,18 +511,18 @@ async def perform_tts(device_id: str, text: str, mina: MiNAService) -> Any:
 
         # 有 tts command 且能获取到数字 did 时，优先通过 miio 指令说话
         if hardware and hardware in TTS_COMMAND:
-            LOGGER.info(f"The device {device_id} , {hardware} In Custom TTS, Call MiIOService TTS.")
+            LOGGER.info("The device %s , %s In Custom TTS, Call MiIOService TTS.", device_id, hardware)
             tts_cmd = TTS_COMMAND[hardware]
             text_no_spaces = text.replace(" ", ",")  # miio 指令中不能包含空格
 
-            # MiIOService 需要账号实例
-            miio_service = MiIOService(mina.account)
+            # MiIOService 需要账号实例，按账号复用
+            miio_service = get_miio_service(mina.account)
 
             # 数值型 miotDID
             did = str(device_info.get("miotDID") or "") if device_info else ""
             if did.isdigit():
                 try:
-                    siid, aiid = [int(x) for x in tts_cmd.split("-")] if "-" in tts_cmd else (int(tts_cmd), 1)
+                    siid, aiid = parse_tts_cmd(tts_cmd)
                     LOGGER.info("Call MiIOService.miotspec.action siid=%s aiid=%s", siid, aiid)
                     result = await miio_service.miot_action(did, (siid, aiid), [text_no_spaces])
                     return result
@@ -629,7 +535,7 @@ async def perform_tts(device_id: str, text: str, mina: MiNAService) -> Any:
             result = await mina.text_to_speech(device_id, text)
             return result
     except Exception as e:
-        LOGGER.exception(f"Exception during TTS: {e}")
+        LOGGER.exception("Exception during TTS: %s", e)
         raise
 
 """TTS 路由已移至 routes_mi.py"""
@@ -1,37 +1,120 @@
 import asyncio
+import hashlib
 import logging
 import os
-from typing import Optional, Dict, Any, List
+import time
+from typing import Optional, Dict, Any, List, Tuple
 
+import orjson
 from aiohttp import ClientSession, ClientTimeout
 from cachetools import TTLCache
 from fastapi import HTTPException, status
 
 from miservice import MiAccount, MiNAService, MiIOService
 
+from const import DEVICE_LIST_URL, MIHOME_HEADERS
+from utils import build_device_index
+
+try:
+    from watchfiles import awatch
+except ImportError:  # 未安装 watchfiles 时回退到轮询
+    awatch = None
+
 
 LOGGER = logging.getLogger("xiaomi_api.session")
 
+# 设备列表缓存有效期（秒）
+_DEVICES_CACHE_TTL = 30
+
+# 查询播放状态时固定的 ubus message
+_APP_IOS_MESSAGE = orjson.dumps({"media": "app_ios"}).decode()
+
+# MiIOService 只是账号的薄封装；同一时间只有一个活动账号，单槽复用即可
+_miio_service: Optional[MiIOService] = None
+
+
+def get_miio_service(account: MiAccount) -> MiIOService:
+    """按账号复用 MiIOService，账号切换（重新登录/热加载）后自动重建。"""
+    global _miio_service
+    service = _miio_service
+    if service is None or service.account is not account:
+        service = MiIOService(account)
+        _miio_service = service
+    return service
+
 
 class MinaProvider:
     """封装 Xiaomi 会话、设备列表 TTL 缓存与并发锁。"""
 
-    def __init__(self, token_path: str, http_session: Optional[ClientSession] = None):
+    def __init__(self, token_path: str, http_session: Optional[ClientSession] = None, watch_interval: float = 30.0):
         self.token_path = token_path
         self.http_session = http_session
+        # 未安装 watchfiles 时轮询会话文件的间隔（秒）
+        self.watch_interval = watch_interval
         self.mi_account: Optional[MiAccount] = None
         self.mina_service: Optional[MiNAService] = None
         self._lock = asyncio.Lock()
-        # 设备列表缓存：最大 64 条，TTL 30 秒
-        self._devices_cache = TTLCache(maxsize=64, ttl=30)
+        # 设备列表缓存：(写入时的 monotonic 时间, (设备列表, 选择器索引, deviceID -> 设备信息))
+        self._devices_cache: Optional[Tuple[float, Tuple[List[Dict[str, Any]], Dict[str, str], Dict[str, Dict[str, Any]]]]] = None
+        # 设备列表单飞刷新锁；代数在会话切换时递增，避免刷新期间切换账号后写回旧设备列表
+        self._devices_lock = asyncio.Lock()
+        self._devices_generation = 0
+        # 播放状态缓存：deviceID -> ubus 响应，TTL 1 秒，吸收前端对状态/音量的轮询；
+        # 按设备单飞查询，控制类写操作后失效，代数用于丢弃写操作前发出的查询结果
+        self._status_cache = TTLCache(maxsize=64, ttl=1.0)
+        self._status_locks: Dict[str, asyncio.Lock] = {}
+        self._status_generation = 0
         # 文件监听
         self._watch_task: Optional[asyncio.Task] = None
         self._stop_watch_event: Optional[asyncio.Event] = None
         self._last_mtime: Optional[float] = None
+        # 当前会话对应的会话文件内容摘要，以及按摘要缓存的校验结果（最大 4 条，TTL 60 秒）
+        self._token_digest: Optional[bytes] = None
+        self._probe_cache = TTLCache(maxsize=4, ttl=60)
 
     def set_http_session(self, session: ClientSession) -> None:
         self.http_session = session
 
+    def _invalidate_devices(self) -> None:
+        """会话切换时丢弃设备缓存。
+
+        多 worker 部署下各进程共享同一个会话文件，登录/登出写入或删除文件后，
+        其余进程依靠各自的会话文件监听（_watch_session_file）重新加载会话并调用这里，
+        不另设共享缓存。因此跨进程一致性取决于监听能否发现变化：
+        - 未安装 watchfiles 或事件监听失败时退回轮询，其余进程最多延迟 mi.watch_interval_seconds；
+        - 会话文件单独 bind mount 时无法被删除（unlink 报 EBUSY），登出不会传播到其余进程。
+        """
+        self._devices_generation += 1
+        self._devices_cache = None
+        self._status_generation += 1
+        self._status_cache.clear()
+
+    def _token_mtime(self) -> Optional[float]:
+        """会话文件的 mtime，文件不存在时返回 None；一次 stat 完成存在性判断。"""
+        try:
+            return os.stat(self.token_path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _sync_token_mtime(self) -> None:
+        # 记录本进程刚写入/删除会话文件后的 mtime，避免文件监听再对自己的写入做一次热加载
+        self._last_mtime = self._token_mtime()
+
+    def _read_token_digest(self) -> Optional[bytes]:
+        """会话文件内容的短摘要，文件不存在时返回 None。"""
+        try:
+            with open(self.token_path, "rb") as f:
+                return hashlib.blake2b(f.read(), digest_size=8).digest()
+        except FileNotFoundError:
+            return None
+
+    def _token_file_state(self, last_mtime: Optional[float]) -> Tuple[Optional[float], Optional[bytes]]:
+        """(mtime, 内容摘要)；mtime 与 last_mtime 相同时不读取内容。在线程中调用。"""
+        mtime = self._token_mtime()
+        if mtime is None or mtime == last_mtime:
+            return mtime, None
+        return mtime, self._read_token_digest()
+
     async def try_restore_from_file(self) -> bool:
         if self.http_session is None:
             return False
@@ -42,58 +125,148 @@ class MinaProvider:
             return False
         account.token = token
         # 调一次设备列表检查 token 是否可用
-        headers = {'User-Agent': 'MiHome/6.0.103 (com.xiaomi.mihome; build:6.0.103.1; iOS 14.4.0) Alamofire/6.0.103 MICO/iOSApp/appStore/6.0.103'}
-        url = 'https://api2.mina.mi.com/admin/v2/device_list?master=0'
         try:
-            resp = await account.mi_request('micoapi', url, None, headers, relogin=False)
+            resp = await account.mi_request('micoapi', DEVICE_LIST_URL, None, MIHOME_HEADERS, relogin=False)
             if resp and resp.get('code') == 0:
                 self.mi_account = account
                 self.mina_service = MiNAService(account)
+                self._token_digest = await asyncio.to_thread(self._read_token_digest)
                 return True
             return False
         except Exception as exc:
             LOGGER.warning("会话文件验证失败：%s", exc)
             return False
 
-    async def _watch_session_file(self, interval_seconds: float = 2.0) -> None:
+    async def _reload_from_token_file(self) -> None:
+        """会话文件变更后：存在则校验并热加载，被删除则清理当前会话。"""
+        # stat 与读取内容一起放到线程中，避免网络文件系统上的慢 IO 阻塞事件循环
+        mtime, digest = await asyncio.to_thread(self._token_file_state, self._last_mtime)
+        exists = mtime is not None
+        # mtime 未变化（如同一次保存触发多个事件）时不重复处理
+        if mtime == self._last_mtime:
+            return
+        self._last_mtime = mtime
+        if exists and self.http_session is not None:
+            # 只是 touch 或编辑器重复保存，内容与当前会话一致时无需重新校验
+            if digest == self._token_digest and self.mina_service is not None:
+                return
+            probed = self._probe_cache.get(digest)
+            if probed is False:
+                LOGGER.warning("会话文件内容近期已验证失败，跳过热加载")
+                return
+            LOGGER.info("检测到会话文件变更，尝试热加载…")
+            account = MiAccount(self.http_session, "", "", self.token_path)
+            token = await account.token_store.load_token()
+            if token:
+                account.token = token
+                try:
+                    if probed is None:
+                        resp = await account.mi_request('micoapi', DEVICE_LIST_URL, None, MIHOME_HEADERS, relogin=False)
+                        probed = bool(resp and resp.get('code') == 0)
+                        self._probe_cache[digest] = probed
+                    if probed and self._last_mtime == mtime:
+                        self.mi_account = account
+                        self.mina_service = MiNAService(account)
+                        self._token_digest = digest
+                        self._invalidate_devices()
+                        LOGGER.info("会话文件热加载成功")
+                    elif probed:
+                        # 校验期间文件再次变化（如被删除），以最新状态为准
+                        LOGGER.info("会话文件在校验期间已变化，放弃本次热加载")
+                    else:
+                        LOGGER.warning("会话文件热加载验证失败(code!=0)，保持现状")
+                except Exception as exc:
+                    LOGGER.warning("会话文件热加载失败：%s", exc)
+        else:
+            self._drop_session_for_deleted_file()
+
+    def _drop_session_for_deleted_file(self) -> None:
+        # 文件被删除，清理当前会话
+        LOGGER.info("会话文件被删除，清理当前会话状态")
+        self._last_mtime = None
+        self.mi_account = None
+        self.mina_service = None
+        self._token_digest = None
+        self._invalidate_devices()
+
+    async def _watch_session_file(self) -> None:
         """后台任务：监听 token 文件变化，自动热加载/清理会话。"""
-        self._last_mtime = os.path.getmtime(self.token_path) if os.path.exists(self.token_path) else None
-        headers = {'User-Agent': 'MiHome/6.0.103 (com.xiaomi.mihome; build:6.0.103.1; iOS 14.4.0) Alamofire/6.0.103 MICO/iOSApp/appStore/6.0.103'}
-        url = 'https://api2.mina.mi.com/admin/v2/device_list?master=0'
+        self._sync_token_mtime()
+        # 发现变化与校验 token 分属两个协程：校验要走网络，卡住时也不影响删除等变化的及时处理
+        queue: asyncio.Queue = asyncio.Queue()
+        await asyncio.gather(self._file_watch_loop(queue), self._housekeeping_loop(queue))
+
+    async def _on_token_file_changed(self, queue: asyncio.Queue) -> None:
+        mtime = await asyncio.to_thread(self._token_mtime)
+        if mtime is None:
+            # 删除无需网络请求，直接生效
+            if self._last_mtime is not None:
+                self._drop_session_for_deleted_file()
+        elif mtime != self._last_mtime:
+            queue.put_nowait(mtime)
+
+    async def _file_watch_loop(self, queue: asyncio.Queue) -> None:
+        """只负责发现会话文件变化；结束时放入 None 通知 _housekeeping_loop 退出。"""
         stop_event = self._stop_watch_event
-        while stop_event and not stop_event.is_set():
-            await asyncio.sleep(interval_seconds)
+        token_path = os.path.abspath(self.token_path)
+        watch_dir = os.path.dirname(token_path)
+        try:
+            if awatch is not None and os.path.isdir(watch_dir):
+                # 由系统文件事件唤醒，空闲时不产生任何 stat 调用；
+                # NFS/CIFS 等不支持文件事件的挂载可设置 WATCHFILES_FORCE_POLLING=true。
+                # 会话文件单独 bind mount（如 docker -v 挂载单个文件）时，目录监听收不到该文件的事件，
+                # 因此文件存在时同时直接监听文件本身；目录监听负责文件的创建与替换
+                watch_paths = [watch_dir]
+                if os.path.exists(token_path):
+                    watch_paths.append(token_path)
+                try:
+                    async for changes in awatch(*watch_paths, stop_event=stop_event, recursive=False, debounce=200):
+                        if not any(path == token_path for _, path in changes):
+                            continue
+                        try:
+                            await self._on_token_file_changed(queue)
+                        except Exception:
+                            # 忽略单次处理的异常，继续监听
+                            pass
+                    return
+                except Exception as exc:
+                    # 如 inotify 监听数达到上限、文件系统不支持事件等，改为轮询继续监听
+                    LOGGER.warning("会话文件事件监听失败，改为轮询：%s", exc)
+                    try:
+                        await self._on_token_file_changed(queue)
+                    except Exception:
+                        pass
+            # 未安装 watchfiles 或事件监听失败时回退到 mtime 轮询
+            while stop_event and not stop_event.is_set():
+                # 等待停止信号直至超时，停止时立即退出而不必等满一个间隔
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=self.watch_interval)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+                try:
+                    await self._on_token_file_changed(queue)
+                except Exception:
+                    # 忽略单次检查的异常，继续下一轮
+                    pass
+        finally:
+            queue.put_nowait(None)
+
+    async def _housekeeping_loop(self, queue: asyncio.Queue) -> None:
+        """消费文件变化：合并短时间内的连续变化后校验 token 并热加载。"""
+        while await queue.get() is not None:
+            # 编辑器保存常伴随多次写入，稍等片刻一并处理
+            await asyncio.sleep(0.1)
+            stop = False
+            while not queue.empty():
+                stop = queue.get_nowait() is None or stop
             try:
-                exists = os.path.exists(self.token_path)
-                mtime = os.path.getmtime(self.token_path) if exists else None
-                if mtime != self._last_mtime:
-                    self._last_mtime = mtime
-                    if exists and self.http_session is not None:
-                        LOGGER.info("检测到会话文件变更，尝试热加载…")
-                        account = MiAccount(self.http_session, "", "", self.token_path)
-                        token = await account.token_store.load_token()
-                        if token:
-                            account.token = token
-                            try:
-                                resp = await account.mi_request('micoapi', url, None, headers, relogin=False)
-                                if resp and resp.get('code') == 0:
-                                    self.mi_account = account
-                                    self.mina_service = MiNAService(account)
-                                    self._devices_cache.clear()
-                                    LOGGER.info("会话文件热加载成功")
-                                else:
-                                    LOGGER.warning("会话文件热加载验证失败(code!=0)，保持现状")
-                            except Exception as exc:
-                                LOGGER.warning("会话文件热加载失败：%s", exc)
-                    else:
-                        # 文件被删除，清理当前会话
-                        LOGGER.info("会话文件被删除，清理当前会话状态")
-                        self.mi_account = None
-                        self.mina_service = None
-                        self._devices_cache.clear()
+                await self._reload_from_token_file()
             except Exception:
-                # 忽略单次检查的异常，继续下一轮
+                # 忽略单次处理的异常，继续等待下一次变化
                 pass
+            if stop:
+                return
 
     async def start_session_file_watcher(self) -> None:
         if self._watch_task is not None and not self._watch_task.done():
@@ -139,54 +312,104 @@ class MinaProvider:
                 raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="小米账号登录失败")
             self.mi_account = account
             self.mina_service = MiNAService(account)
-            self._devices_cache.clear()
+            self._token_digest = await asyncio.to_thread(self._read_token_digest)
+            self._invalidate_devices()
+            self._sync_token_mtime()
 
     async def logout(self) -> None:
         async with self._lock:
             self.mi_account = None
             self.mina_service = None
-            self._devices_cache.clear()
+            self._token_digest = None
+            self._invalidate_devices()
             # 删除会话文件
             try:
-                import os
-                if os.path.exists(self.token_path):
-                    os.remove(self.token_path)
-            except Exception:
+                os.unlink(self.token_path)
+            except FileNotFoundError:
                 pass
+            except OSError as exc:
+                LOGGER.warning("删除会话文件失败：%s", exc)
+            self._sync_token_mtime()
 
     async def ensure_mina(self) -> MiNAService:
         if not self.mina_service:
             raise HTTPException(status_code=401, detail="请先登录小米账号")
         return self.mina_service
 
+    async def _devices_entry(self) -> Tuple[List[Dict[str, Any]], Dict[str, str], Dict[str, Dict[str, Any]]]:
+        # 单条缓存只需比较时间戳，过期自动刷新；索引随设备列表一起构建，查询时均为 O(1)
+        cached = self._devices_cache
+        if cached is not None and time.monotonic() - cached[0] < _DEVICES_CACHE_TTL:
+            return cached[1]
+        # 单飞刷新：缓存过期时只有一个协程请求设备列表，其余等待后复用结果
+        async with self._devices_lock:
+            cached = self._devices_cache
+            if cached is not None and time.monotonic() - cached[0] < _DEVICES_CACHE_TTL:
+                return cached[1]
+            mina = await self.ensure_mina()
+            generation = self._devices_generation
+            devices = await mina.device_list() or []
+            by_id: Dict[str, Dict[str, Any]] = {}
+            for d in devices:
+                if d.get("deviceID"):
+                    by_id.setdefault(d["deviceID"], d)
+            entry = (devices, build_device_index(devices), by_id)
+            if generation == self._devices_generation:
+                self._devices_cache = (time.monotonic(), entry)
+            return entry
+
     async def device_list(self) -> List[Dict[str, Any]]:
-        # TTL 缓存：key 固定，过期自动刷新
-        devices = self._devices_cache.get("devices")
-        if devices is not None:
-            return devices
+        return (await self._devices_entry())[0]
+
+    async def resolve(self, selector: str) -> Tuple[MiNAService, str]:
+        """一次取得 (MiNAService, deviceID)，供设备控制路由使用。"""
         mina = await self.ensure_mina()
-        devices = await mina.device_list() or []
-        self._devices_cache["devices"] = devices
-        return devices
+        return mina, await self.resolve_device_id(selector)
+
+    async def play_status(self, mina: MiNAService, device_id: str) -> Any:
+        """查询设备播放状态（player_get_play_status），响应中的 info 已解析为 dict。"""
+        resp = self._status_cache.get(device_id)
+        if resp is not None:
+            return resp
+        lock = self._status_locks.setdefault(device_id, asyncio.Lock())
+        async with lock:
+            resp = self._status_cache.get(device_id)
+            if resp is not None:
+                return resp
+            generation = self._status_generation
+            payload = {
+                "deviceId": device_id,
+                "message": _APP_IOS_MESSAGE,
+                "method": "player_get_play_status",
+                "path": "mediaplayer",
+            }
+            resp = await mina.mina_request("/remote/ubus", payload)
+            try:
+                if isinstance(resp, dict) and isinstance(resp.get("data"), dict):
+                    info = resp["data"].get("info")
+                    if isinstance(info, str):
+                        resp["data"]["info"] = orjson.loads(info)
+            except Exception:
+                pass
+            if resp is not None and generation == self._status_generation:
+                self._status_cache[device_id] = resp
+            return resp
+
+    def invalidate_play_status(self, device_id: str) -> None:
+        """播放控制/音量等写操作后调用，使下一次查询拿到最新状态。"""
+        self._status_generation += 1
+        self._status_cache.pop(device_id, None)
+
+    async def device_info(self, device_id: str) -> Optional[Dict[str, Any]]:
+        return (await self._devices_entry())[2].get(device_id)
 
     async def resolve_device_id(self, selector: str) -> str:
-        devices = await self.device_list()
+        # 选择器可为 deviceID、miotDID 或名称/别名，空字符串表示第一台设备
+        device_id = (await self._devices_entry())[1].get(selector or "")
+        if device_id:
+            return device_id
         if not selector:
-            if not devices:
-                raise HTTPException(status_code=400, detail="没有可用设备")
-            return devices[0].get("deviceID")
-        # 1) 直接是 deviceID
-        if "-" in selector and any(d.get("deviceID") == selector for d in devices):
-            return selector
-        # 2) 纯数字 miotDID
-        if selector.isdigit():
-            for d in devices:
-                if str(d.get("miotDID")) == selector:
-                    return d.get("deviceID")
-        # 3) 名称/别名
-        for d in devices:
-            if d.get("alias") == selector or d.get("name") == selector:
-                return d.get("deviceID")
+            raise HTTPException(status_code=400, detail="没有可用设备")
         raise HTTPException(status_code=400, detail=f"未找到匹配的设备: {selector}")
 
 
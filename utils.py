@@ -1,4 +1,6 @@
-from typing import Any, Dict, List, Optional, Tuple
+import json
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple
 
 
 def build_music_payload(url: str) -> Dict[str, Any]:
@@ -20,11 +22,23 @@ def build_music_payload(url: str) -> Dict[str, Any]:
     }
 
 
+# 播放载荷除 URL 外均为常量，预先序列化一次，请求时只替换 URL 占位符
+_MUSIC_URL_PLACEHOLDER = '"__URL__"'
+_MUSIC_JSON_TEMPLATE = json.dumps(build_music_payload("__URL__"))
+
+
+def build_music_json(url: str) -> str:
+    # 与 json.dumps(build_music_payload(url)) 结果一致
+    return _MUSIC_JSON_TEMPLATE.replace(_MUSIC_URL_PLACEHOLDER, json.dumps(url), 1)
+
+
 def sanitize_tts_text(text: str) -> str:
     # miio TTS 指令不允许空格，将空格替换为逗号
+    # str.replace 单字符替换走 C 快路径，比 str.translate 更快（中文文本尤甚），且无空格时直接返回原对象
     return text.replace(" ", ",")
 
 
+@lru_cache(maxsize=64)
 def parse_tts_cmd(tts_cmd: str) -> Tuple[int, int]:
     # 形如 "5-3" -> (5, 3)；仅数字则默认为 (cmd, 1)
     if "-" in tts_cmd:
@@ -33,7 +47,25 @@ def parse_tts_cmd(tts_cmd: str) -> Tuple[int, int]:
     return int(tts_cmd), 1
 
 
-def find_device_info_by_id(devices: List[Dict[str, Any]], device_id: str) -> Optional[Dict[str, Any]]:
-    return next((d for d in devices if d.get("deviceID") == device_id), None)
-
-
+def build_device_index(devices: List[Dict[str, Any]]) -> Dict[str, str]:
+    # 选择器 -> deviceID；优先级 deviceID > miotDID > 别名/名称，同级先出现者优先
+    # 空字符串映射到第一台设备，对应“未指定设备”的默认选择
+    by_id: Dict[str, str] = {}
+    by_did: Dict[str, str] = {}
+    by_name: Dict[str, str] = {}
+    for d in devices:
+        device_id = d.get("deviceID")
+        if not device_id:
+            continue
+        by_id.setdefault(device_id, device_id)
+        did = d.get("miotDID")
+        if did:
+            by_did.setdefault(str(did), device_id)
+        for key in (d.get("alias"), d.get("name")):
+            if key:
+                by_name.setdefault(key, device_id)
+    # 低优先级先合并，高优先级覆盖同名键
+    index = {**by_name, **by_did, **by_id}
+    if devices and devices[0].get("deviceID"):
+        index[""] = devices[0].get("deviceID")
+    return index